@@ -1,15 +1,25 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from contextlib import asynccontextmanager, suppress
+from collections import OrderedDict
 import os
+import re
+import math
+import time
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import openai
+import httpx
 import base64
 
 ROOT_DIR = Path(__file__).parent
@@ -17,14 +27,134 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=int(os.environ.get('MONGO_MAX_POOL_SIZE', '100')),
+    minPoolSize=int(os.environ.get('MONGO_MIN_POOL_SIZE', '10')),
+    maxIdleTimeMS=int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000')),
+    serverSelectionTimeoutMS=int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+)
 db = client[os.environ['DB_NAME']]
 
-# OpenAI setup
-openai.api_key = os.environ['OPENAI_API_KEY']
+# OpenAI setup, idle connections are kept long enough for the warm-up one to be reused
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', '120'))
+OPENAI_WARMUP_TIMEOUT = float(os.environ.get('OPENAI_WARMUP_TIMEOUT', '10'))
+openai_client = openai.AsyncOpenAI(
+    api_key=os.environ['OPENAI_API_KEY'],
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=1000,
+            max_keepalive_connections=100,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+        )
+    )
+)
+
+# Rate limiting for send_message (token buckets: capacity + refill per second)
+def env_float(name: str, default: str, minimum: float, strict: bool = False) -> float:
+    """Read a numeric setting, refusing to start on values the limiter cannot use"""
+    value = float(os.environ.get(name, default))
+    too_small = value <= minimum if strict else value < minimum
+    if not math.isfinite(value) or too_small:
+        bound = f"> {minimum}" if strict else f">= {minimum}"
+        raise ValueError(f"{name} must be a finite number {bound}, got {value}")
+    return value
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'memory')  # memory or mongo
+if RATE_LIMIT_STORE not in ("memory", "mongo"):
+    raise ValueError(f"RATE_LIMIT_STORE must be 'memory' or 'mongo', got {RATE_LIMIT_STORE!r}")
+RATE_LIMIT_USER_CAPACITY = env_float('RATE_LIMIT_USER_CAPACITY', '10', 1)
+RATE_LIMIT_USER_REFILL = env_float('RATE_LIMIT_USER_REFILL', '0.5', 0, strict=True)
+RATE_LIMIT_PERSONALITY_CAPACITY = env_float('RATE_LIMIT_PERSONALITY_CAPACITY', '60', 1)
+RATE_LIMIT_PERSONALITY_REFILL = env_float('RATE_LIMIT_PERSONALITY_REFILL', '5', 0, strict=True)
+# Client buckets are keyed on request.client.host. Behind an ingress, run uvicorn with
+# --proxy-headers --forwarded-allow-ips=<ingress CIDR or *> so that is the real caller,
+# otherwise every user shares the ingress address and a single client bucket.
+
+# Startup warm-up, Mongo steps are retried until reachable
+WARMUP_RETRY_SECONDS = float(os.environ.get('WARMUP_RETRY_SECONDS', '2'))
+warmup_state = {
+    "ready": False,
+    "failed": False,
+    "error": None,
+    "steps": {"mongo": False, "indexes": False, "personalities": False, "openai": False}
+}
+
+async def ping_mongo():
+    """Open the first pooled connection to Mongo"""
+    await client.admin.command("ping")
+
+async def ensure_indexes():
+    """Create the indexes the routes and rate limiter query by"""
+    await db.chats.create_index([("id", ASCENDING)], unique=True)
+    await db.chats.create_index([("ai_personality", ASCENDING)])
+    await db.messages.create_index([("id", ASCENDING)], unique=True)
+    await db.messages.create_index([("chat_id", ASCENDING), ("timestamp", DESCENDING)])
+    if isinstance(rate_limit_store, MongoRateLimitStore):
+        await rate_limit_store.ensure_indexes()
+
+async def preload_personalities():
+    """Make sure every personality has a chat and cache chat_id -> personality"""
+    for personality_id in AI_PERSONALITIES:
+        await db.chats.update_one(
+            {"ai_personality": personality_id},
+            {"$setOnInsert": Chat(ai_personality=personality_id).dict()},
+            upsert=True
+        )
+
+    db_chats = await db.chats.find({}, {"id": 1, "ai_personality": 1}).to_list(1000)
+    for chat in db_chats:
+        chat_personalities[chat["id"]] = chat["ai_personality"]
+
+async def warm_openai():
+    """Open the pooled HTTPS connection so the first completion skips the TLS handshake"""
+    await openai_client.with_options(timeout=OPENAI_WARMUP_TIMEOUT).models.list()
+
+async def warm_up():
+    """Open connections and load data before the worker reports ready"""
+    steps = [("mongo", ping_mongo), ("indexes", ensure_indexes), ("personalities", preload_personalities)]
+    for name, step in steps:
+        while not warmup_state["steps"][name]:
+            try:
+                await step()
+                warmup_state["steps"][name] = True
+                warmup_state["error"] = None
+            except OperationFailure as e:
+                # The server answered and refused (index conflict, duplicate ids, auth), retrying
+                # will not help. Unreachable or stepped-down servers raise ConnectionFailure instead.
+                warmup_state["failed"] = True
+                warmup_state["error"] = f"{name}: {str(e)}"
+                logging.critical(f"Warm-up step {name} failed, worker will never become ready: {str(e)}")
+                return
+            except Exception as e:
+                warmup_state["error"] = f"{name}: {str(e)}"
+                logging.error(f"Error warming up {name}, retrying: {str(e)}")
+                await asyncio.sleep(WARMUP_RETRY_SECONDS)
+
+    # OpenAI outages already fall back to a canned reply, so a failure here is reported but not fatal
+    try:
+        await warm_openai()
+        warmup_state["steps"]["openai"] = True
+    except Exception as e:
+        warmup_state["error"] = f"openai: {str(e)}"
+        logging.warning(f"Error warming up OpenAI connection: {str(e)}")
+
+    warmup_state["ready"] = True
+    logging.info("Worker warm-up finished")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup_task = asyncio.create_task(warm_up())
+    yield
+    warmup_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await warmup_task
+    await openai_client.close()
+    client.close()
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -140,6 +270,121 @@ class AIResponse(BaseModel):
     message: str
     typing_duration: int  # milliseconds to simulate typing
 
+# Rate Limiting
+class MemoryRateLimitStore:
+    """In-process token buckets, good enough for a single worker"""
+
+    MAX_BUCKETS = 10000
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.buckets = OrderedDict()  # key -> (tokens, updated), least recently used first
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, key: str, capacity: float, refill: float) -> float:
+        """Take one token from the bucket, returns seconds to wait (0 if allowed)"""
+        async with self.lock:
+            now = self.clock()
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * refill)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            # Evict the idlest bucket, it is the one most likely to have refilled anyway
+            if len(self.buckets) > self.MAX_BUCKETS:
+                self.buckets.popitem(last=False)
+
+            if allowed:
+                return 0.0
+            return (1 - tokens) / refill
+
+    async def release(self, key: str, capacity: float):
+        """Give back a token taken by acquire"""
+        async with self.lock:
+            if key in self.buckets:
+                tokens, updated = self.buckets[key]
+                self.buckets[key] = (min(capacity, tokens + 1), updated)
+
+class MongoRateLimitStore:
+    """Token buckets shared between workers through the rate_limits collection"""
+
+    def __init__(self, collection, clock=time.time):
+        self.collection = collection
+        self.clock = clock
+        self.indexes_ready = False
+        self.index_lock = asyncio.Lock()
+
+    async def ensure_indexes(self):
+        """Unique bucket keys for safe upserts, TTL so idle buckets get cleaned up"""
+        async with self.index_lock:
+            if self.indexes_ready:
+                return
+            await self.collection.create_index([("key", ASCENDING)], unique=True)
+            await self.collection.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+            self.indexes_ready = True
+
+    async def acquire(self, key: str, capacity: float, refill: float) -> float:
+        """Take one token from the bucket, returns seconds to wait (0 if allowed)"""
+        if not self.indexes_ready:
+            await self.ensure_indexes()
+
+        now = self.clock()
+        # Refill and consume in a single atomic pipeline update
+        refilled = {
+            "$min": [
+                capacity,
+                {"$add": [
+                    {"$ifNull": ["$tokens", capacity]},
+                    {"$multiply": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, refill]}
+                ]}
+            ]
+        }
+        update = [
+            {"$set": {"tokens": refilled, "updated": now}},
+            {"$set": {
+                "allowed": {"$gte": ["$tokens", 1]},
+                "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                "expires_at": datetime.utcfromtimestamp(now) + timedelta(seconds=capacity / refill)
+            }}
+        ]
+        try:
+            bucket = await self.collection.find_one_and_update(
+                {"key": key}, update, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Another worker created the bucket first, the retry updates that document
+            bucket = await self.collection.find_one_and_update(
+                {"key": key}, update, upsert=True, return_document=ReturnDocument.AFTER
+            )
+
+        if bucket["allowed"]:
+            return 0.0
+        return (1 - bucket["tokens"]) / refill
+
+    async def release(self, key: str, capacity: float):
+        """Give back a token taken by acquire"""
+        await self.collection.update_one(
+            {"key": key},
+            [{"$set": {"tokens": {"$min": [capacity, {"$add": ["$tokens", 1]}]}}}]
+        )
+
+if RATE_LIMIT_STORE == "mongo":
+    rate_limit_store = MongoRateLimitStore(db.rate_limits)
+else:
+    rate_limit_store = MemoryRateLimitStore()
+
+# chat_id -> ai_personality, filled as chats are served so the limiter needs no DB lookup
+chat_personalities = {}
+
+SEND_MESSAGE_PATH = re.compile(r"^/api/chats/([^/]+)/messages/?$")
+
+def get_client_key(request: Request) -> str:
+    """Identify the caller by address, as resolved by uvicorn's proxy header handling"""
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
 # Routes
 @api_router.get("/")
 async def root():
@@ -159,6 +404,7 @@ async def get_chats():
         db_chat = next((chat for chat in db_chats if chat["ai_personality"] == personality_id), None)
         
         if db_chat:
+            chat_personalities[db_chat["id"]] = personality_id
             chat_response = ChatResponse(
                 id=db_chat["id"],
                 ai_personality=personality_id,
@@ -174,6 +420,7 @@ async def get_chats():
             # Create new chat for this personality
             new_chat = Chat(ai_personality=personality_id)
             await db.chats.insert_one(new_chat.dict())
+            chat_personalities[new_chat.id] = personality_id
             
             chat_response = ChatResponse(
                 id=new_chat.id,
@@ -207,6 +454,7 @@ async def send_message(chat_id: str, message_data: MessageCreate):
         raise HTTPException(status_code=404, detail="Chat not found")
     
     personality_id = chat["ai_personality"]
+    chat_personalities[chat_id] = personality_id
     personality_data = AI_PERSONALITIES.get(personality_id)
     
     if not personality_data:
@@ -257,7 +505,7 @@ async def send_message(chat_id: str, message_data: MessageCreate):
         })
         
         # Call OpenAI API
-        response = openai.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model="gpt-4o-mini",  # Using latest model
             messages=conversation_context,
             max_tokens=150,
@@ -305,12 +553,73 @@ async def send_message(chat_id: str, message_data: MessageCreate):
 # Include the router in the main app
 app.include_router(api_router)
 
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving requests"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: connections are open, indexes exist and personalities are loaded"""
+    if warmup_state["ready"]:
+        status = "ready"
+    elif warmup_state["failed"]:
+        status = "failed"
+    else:
+        status = "warming"
+    return JSONResponse(
+        status_code=200 if warmup_state["ready"] else 503,
+        content={"status": status, "steps": warmup_state["steps"], "error": warmup_state["error"]}
+    )
+
+@app.middleware("http")
+async def rate_limit_send_message(request: Request, call_next):
+    """Refuse bursts of send_message calls before any DB or OpenAI work"""
+    match = SEND_MESSAGE_PATH.match(request.url.path)
+    if not RATE_LIMIT_ENABLED or request.method != "POST" or not match:
+        return await call_next(request)
+
+    chat_id = match.group(1)
+    # Chats map one-to-one to personalities, so an unknown chat is limited by its own id
+    personality_key = chat_personalities.get(chat_id, f"chat:{chat_id}")
+
+    client_key = f"client:{get_client_key(request)}"
+    try:
+        retry_after = await rate_limit_store.acquire(
+            client_key,
+            RATE_LIMIT_USER_CAPACITY,
+            RATE_LIMIT_USER_REFILL
+        )
+        if not retry_after:
+            retry_after = await rate_limit_store.acquire(
+                f"personality:{personality_key}",
+                RATE_LIMIT_PERSONALITY_CAPACITY,
+                RATE_LIMIT_PERSONALITY_REFILL
+            )
+            # A busy personality should not eat into the caller's own budget
+            if retry_after:
+                await rate_limit_store.release(client_key, RATE_LIMIT_USER_CAPACITY)
+    except Exception as e:
+        # Fail open, a broken limiter store should not take chats down
+        logging.error(f"Error checking rate limit: {str(e)}")
+        retry_after = 0.0
+
+    if retry_after:
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Too many messages, slow down"},
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+    return await call_next(request)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],
 )
 
 # Configure logging
@@ -319,7 +628,3 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
@@ -0,0 +1,310 @@
+"""
+Rate limiter tests for send_message
+"""
+
+import asyncio
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+from pymongo.errors import DuplicateKeyError
+from starlette.requests import Request
+
+import server
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakeChats:
+    async def find_one(self, query):
+        return None
+
+
+class FakeDB:
+    chats = FakeChats()
+
+
+def evaluate(expr, doc):
+    """Just enough of the aggregation expression language for the bucket pipeline"""
+    if isinstance(expr, str) and expr.startswith("$"):
+        return doc.get(expr[1:])
+    if isinstance(expr, dict) and len(expr) == 1 and next(iter(expr)).startswith("$"):
+        op, args = next(iter(expr.items()))
+        values = [evaluate(arg, doc) for arg in args]
+        if op == "$ifNull":
+            return values[0] if values[0] is not None else values[1]
+        if op == "$cond":
+            return values[1] if values[0] else values[2]
+        operators = {
+            "$min": lambda a, b: min(a, b),
+            "$add": lambda a, b: a + b,
+            "$subtract": lambda a, b: a - b,
+            "$multiply": lambda a, b: a * b,
+            "$gte": lambda a, b: a >= b,
+        }
+        return operators[op](*values)
+    return expr
+
+
+def apply_pipeline(pipeline, doc):
+    for stage in pipeline:
+        (name, fields), = stage.items()
+        assert name == "$set"
+        # Every field in a stage sees the document as it was before the stage
+        doc = {**doc, **{field: evaluate(value, doc) for field, value in fields.items()}}
+    return doc
+
+
+class FakeBucketCollection:
+    """Applies pipeline updates to in-memory documents keyed by bucket key"""
+
+    def __init__(self, duplicate_key_errors=0):
+        self.docs = {}
+        self.indexes = []
+        self.updates = []
+        self.duplicate_key_errors = duplicate_key_errors
+
+    async def create_index(self, keys, **kwargs):
+        self.indexes.append((keys, kwargs))
+
+    async def find_one_and_update(self, query, pipeline, upsert=False, return_document=None):
+        self.updates.append((query, upsert))
+        if self.duplicate_key_errors:
+            self.duplicate_key_errors -= 1
+            self.docs.setdefault(query["key"], {"key": query["key"]})
+            raise DuplicateKeyError("E11000 duplicate key error")
+        doc = apply_pipeline(pipeline, self.docs.get(query["key"], {"key": query["key"]}))
+        self.docs[query["key"]] = doc
+        return doc
+
+    async def update_one(self, query, pipeline):
+        if query["key"] in self.docs:
+            self.docs[query["key"]] = apply_pipeline(pipeline, self.docs[query["key"]])
+
+
+class BrokenStore:
+    async def acquire(self, key, capacity, refill):
+        raise RuntimeError("store is down")
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def api(monkeypatch, clock):
+    """App with a fresh memory store and a DB where every chat is missing (404)"""
+    monkeypatch.setattr(server, "db", FakeDB())
+    monkeypatch.setattr(server, "rate_limit_store", server.MemoryRateLimitStore(clock=clock))
+    monkeypatch.setattr(server, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(server, "RATE_LIMIT_USER_CAPACITY", 3)
+    monkeypatch.setattr(server, "RATE_LIMIT_USER_REFILL", 0.5)
+    monkeypatch.setattr(server, "RATE_LIMIT_PERSONALITY_CAPACITY", 100)
+    monkeypatch.setattr(server, "RATE_LIMIT_PERSONALITY_REFILL", 5)
+    return TestClient(server.app)
+
+
+def send(api, chat_id="chat-1", **kwargs):
+    return api.post(f"/api/chats/{chat_id}/messages", json={"chat_id": chat_id, "content": "hi"}, **kwargs)
+
+
+def make_request(host, headers=None):
+    return Request({
+        "type": "http",
+        "method": "POST",
+        "path": "/api/chats/chat-1/messages",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        "client": (host, 1234),
+    })
+
+
+def test_memory_store_refuses_past_capacity_and_refills(clock):
+    store = server.MemoryRateLimitStore(clock=clock)
+
+    for _ in range(3):
+        assert run(store.acquire("a", 3, 0.5)) == 0.0
+    assert run(store.acquire("a", 3, 0.5)) == pytest.approx(2.0)
+
+    clock.now += 1
+    assert run(store.acquire("a", 3, 0.5)) == pytest.approx(1.0)
+
+    clock.now += 2
+    assert run(store.acquire("a", 3, 0.5)) == 0.0
+
+
+def test_memory_store_keeps_buckets_with_different_parameters(clock):
+    store = server.MemoryRateLimitStore(clock=clock)
+    store.MAX_BUCKETS = 3
+
+    for _ in range(30):
+        run(store.acquire("personality:alex", 60, 5))
+    for key in ("client:a", "client:b"):
+        run(store.acquire(key, 10, 0.5))
+
+    assert store.buckets["personality:alex"][0] == pytest.approx(30)
+
+
+def test_memory_store_evicts_least_recently_used(clock):
+    store = server.MemoryRateLimitStore(clock=clock)
+    store.MAX_BUCKETS = 3
+
+    for key in ("a", "b", "c"):
+        run(store.acquire(key, 10, 0.5))
+    run(store.acquire("a", 10, 0.5))
+    run(store.acquire("d", 10, 0.5))
+
+    assert list(store.buckets) == ["c", "a", "d"]
+
+
+def test_burst_gets_429_with_retry_after(api, clock):
+    for _ in range(3):
+        assert send(api).status_code == 404
+
+    response = send(api)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+
+    clock.now += 2
+    assert send(api).status_code == 404
+
+
+def test_rotating_user_header_does_not_reset_bucket(api):
+    for _ in range(3):
+        send(api, headers={"X-User-Id": str(uuid.uuid4())})
+
+    response = send(api, headers={"X-User-Id": str(uuid.uuid4())})
+    assert response.status_code == 429
+
+
+def test_personality_bucket_is_separate(api, monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMIT_USER_CAPACITY", 100)
+    monkeypatch.setattr(server, "RATE_LIMIT_PERSONALITY_CAPACITY", 2)
+    monkeypatch.setitem(server.chat_personalities, "chat-1", "alex_sarcastic")
+    monkeypatch.setitem(server.chat_personalities, "chat-2", "maya_mentor")
+
+    assert send(api, "chat-1").status_code == 404
+    assert send(api, "chat-1").status_code == 404
+    assert send(api, "chat-1").status_code == 429
+    assert send(api, "chat-2").status_code == 404
+
+
+def test_personality_refusal_does_not_charge_client(api, monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMIT_PERSONALITY_CAPACITY", 1)
+    monkeypatch.setitem(server.chat_personalities, "chat-1", "alex_sarcastic")
+
+    assert send(api, "chat-1").status_code == 404
+    for _ in range(5):
+        assert send(api, "chat-1").status_code == 429
+
+    tokens, _ = server.rate_limit_store.buckets["client:ip:testclient"]
+    assert tokens == pytest.approx(2)
+
+
+def test_429_exposes_retry_after_to_browsers(api, monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMIT_USER_CAPACITY", 1)
+    headers = {"Origin": "http://localhost:3000"}
+
+    send(api, headers=headers)
+    response = send(api, headers=headers)
+
+    assert response.status_code == 429
+    assert "retry-after" in response.headers["access-control-expose-headers"].lower()
+
+
+def test_store_error_fails_open(api, monkeypatch):
+    monkeypatch.setattr(server, "rate_limit_store", BrokenStore())
+
+    for _ in range(5):
+        assert send(api).status_code == 404
+
+
+def test_other_routes_are_not_limited(api):
+    for _ in range(5):
+        assert api.get("/api/").status_code == 200
+    assert not server.rate_limit_store.buckets
+
+
+def test_client_key_uses_client_address_not_headers():
+    request = make_request("9.9.9.9", {"X-Forwarded-For": "1.2.3.4", "X-User-Id": "someone"})
+    assert server.get_client_key(request) == "ip:9.9.9.9"
+
+
+@pytest.mark.parametrize("value", ["0", "-1", "nan", "inf"])
+def test_env_float_strict_rejects_unusable_values(monkeypatch, value):
+    monkeypatch.setenv("RATE_LIMIT_TEST_VALUE", value)
+    with pytest.raises(ValueError, match="> 0"):
+        server.env_float("RATE_LIMIT_TEST_VALUE", "1", 0, strict=True)
+
+
+def test_env_float_inclusive_minimum(monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_TEST_VALUE", "1")
+    assert server.env_float("RATE_LIMIT_TEST_VALUE", "10", 1) == 1
+
+    monkeypatch.setenv("RATE_LIMIT_TEST_VALUE", "0.5")
+    with pytest.raises(ValueError, match=">= 1"):
+        server.env_float("RATE_LIMIT_TEST_VALUE", "10", 1)
+
+
+def test_mongo_store_refuses_past_capacity_and_refills(clock):
+    collection = FakeBucketCollection()
+    store = server.MongoRateLimitStore(collection, clock=clock)
+
+    results = [run(store.acquire("a", 3, 0.5)) for _ in range(4)]
+    clock.now += 1
+    results.append(run(store.acquire("a", 3, 0.5)))
+    clock.now += 2
+    results.append(run(store.acquire("a", 3, 0.5)))
+
+    assert results[:3] == [0.0, 0.0, 0.0]
+    assert results[3] == pytest.approx(2.0)
+    assert results[4] == pytest.approx(1.0)
+    assert results[5] == 0.0
+    assert len(collection.docs) == 1
+
+
+def test_mongo_store_sets_expiry_and_creates_indexes(clock):
+    collection = FakeBucketCollection()
+    store = server.MongoRateLimitStore(collection, clock=clock)
+
+    run(store.acquire("a", 10, 0.5))
+    run(store.acquire("b", 10, 0.5))
+
+    bucket = collection.docs["a"]
+    assert bucket["expires_at"] == server.datetime.utcfromtimestamp(clock.now) + server.timedelta(seconds=20)
+    assert collection.indexes == [
+        ([("key", server.ASCENDING)], {"unique": True}),
+        ([("expires_at", server.ASCENDING)], {"expireAfterSeconds": 0}),
+    ]
+
+
+def test_mongo_store_retries_lost_upsert_race(clock):
+    collection = FakeBucketCollection(duplicate_key_errors=1)
+    store = server.MongoRateLimitStore(collection, clock=clock)
+
+    assert run(store.acquire("a", 3, 0.5)) == 0.0
+    assert collection.updates == [({"key": "a"}, True), ({"key": "a"}, True)]
+    assert collection.docs["a"]["tokens"] == pytest.approx(2)
+
+
+def test_stores_release_tokens(clock):
+    for store in (server.MemoryRateLimitStore(clock=clock), server.MongoRateLimitStore(FakeBucketCollection(), clock=clock)):
+        run(store.acquire("a", 2, 0.5))
+        run(store.acquire("a", 2, 0.5))
+        run(store.release("a", 2))
+        assert run(store.acquire("a", 2, 0.5)) == 0.0
+        run(store.release("a", 2))
+        run(store.release("a", 2))
+        run(store.acquire("a", 2, 0.5))
+        run(store.acquire("a", 2, 0.5))
+        assert run(store.acquire("a", 2, 0.5)) > 0
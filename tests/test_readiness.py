@@ -0,0 +1,197 @@
+"""
+Startup warm-up, /healthz and /readyz tests
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from pymongo.errors import OperationFailure, ServerSelectionTimeoutError
+
+import server
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs
+
+
+class FakeCollection:
+    def __init__(self, docs=None, index_error=None):
+        self.docs = docs or []
+        self.index_error = index_error
+        self.calls = []
+
+    async def create_index(self, keys, **kwargs):
+        self.calls.append(("create_index", keys, kwargs))
+        if self.index_error:
+            raise self.index_error
+
+    async def update_one(self, query, update, upsert=False):
+        self.calls.append(("update_one", query))
+        if not any(doc["ai_personality"] == query["ai_personality"] for doc in self.docs):
+            self.docs.append(update["$setOnInsert"])
+
+    def find(self, *args):
+        return FakeCursor(self.docs)
+
+
+class FakeDB:
+    def __init__(self, chats=None, messages=None):
+        self.chats = chats or FakeCollection()
+        self.messages = messages or FakeCollection()
+
+
+class FakeAdmin:
+    def __init__(self, reachable):
+        self.reachable = reachable
+        self.pings = 0
+
+    async def command(self, name):
+        self.pings += 1
+        if not self.reachable.is_set():
+            raise ServerSelectionTimeoutError("localhost:27017: connection refused")
+        return {"ok": 1}
+
+
+class FakeMongoClient:
+    def __init__(self, reachable):
+        self.admin = FakeAdmin(reachable)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeModels:
+    def __init__(self):
+        self.listed = 0
+
+    async def list(self):
+        self.listed += 1
+
+
+class FakeOpenAI:
+    def __init__(self):
+        self.models = FakeModels()
+        self.options = None
+        self.closed = False
+
+    def with_options(self, **options):
+        self.options = options
+        return self
+
+    async def close(self):
+        self.closed = True
+
+
+async def warm_openai():
+    pass
+
+
+@pytest.fixture
+def reachable():
+    return threading.Event()
+
+
+@pytest.fixture
+def mongo(monkeypatch, reachable):
+    mongo = FakeMongoClient(reachable)
+    monkeypatch.setattr(server, "client", mongo)
+    monkeypatch.setattr(server, "db", FakeDB())
+    monkeypatch.setattr(server, "openai_client", FakeOpenAI())
+    monkeypatch.setattr(server, "warm_openai", warm_openai)
+    monkeypatch.setattr(server, "rate_limit_store", server.MemoryRateLimitStore())
+    monkeypatch.setattr(server, "chat_personalities", {})
+    monkeypatch.setattr(server, "WARMUP_RETRY_SECONDS", 0.01)
+    monkeypatch.setattr(server, "warmup_state", {
+        "ready": False,
+        "failed": False,
+        "error": None,
+        "steps": {"mongo": False, "indexes": False, "personalities": False, "openai": False}
+    })
+    return mongo
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_healthz_is_always_ok(mongo):
+    with TestClient(server.app) as api:
+        assert api.get("/healthz").json() == {"status": "ok"}
+
+
+def test_readyz_turns_ready_once_mongo_comes_up(mongo, reachable):
+    with TestClient(server.app) as api:
+        assert wait_for(lambda: mongo.admin.pings >= 2)
+        response = api.get("/readyz")
+        assert response.status_code == 503
+        assert response.json()["status"] == "warming"
+        assert response.json()["error"].startswith("mongo:")
+
+        reachable.set()
+        assert wait_for(lambda: api.get("/readyz").status_code == 200)
+        body = api.get("/readyz").json()
+
+    assert body["steps"] == {"mongo": True, "indexes": True, "personalities": True, "openai": True}
+    assert body["error"] is None
+    assert set(server.chat_personalities.values()) >= set(server.AI_PERSONALITIES)
+    assert mongo.closed
+    assert server.openai_client.closed
+
+
+def test_index_conflict_stops_retrying(mongo, reachable, monkeypatch):
+    conflict = OperationFailure("Index with name: expires_at_1 already exists with different options", code=85)
+    chats = FakeCollection(index_error=conflict)
+    monkeypatch.setattr(server, "db", FakeDB(chats=chats))
+    reachable.set()
+
+    with TestClient(server.app) as api:
+        assert wait_for(lambda: server.warmup_state["error"] is not None)
+        time.sleep(0.05)
+        response = api.get("/readyz")
+
+    assert response.status_code == 503
+    assert response.json()["status"] == "failed"
+    assert response.json()["error"].startswith("indexes:")
+    assert len([call for call in chats.calls if call[0] == "create_index"]) == 1
+
+
+def test_openai_failure_is_reported_but_not_fatal(mongo, reachable, monkeypatch):
+    async def failing_warm_openai():
+        raise TimeoutError("api.openai.com timed out")
+
+    monkeypatch.setattr(server, "warm_openai", failing_warm_openai)
+    reachable.set()
+
+    with TestClient(server.app) as api:
+        assert wait_for(lambda: api.get("/readyz").status_code == 200)
+        body = api.get("/readyz").json()
+
+    assert body["steps"]["openai"] is False
+    assert body["error"].startswith("openai:")
+
+
+def test_warm_openai_awaits_async_client(monkeypatch):
+    fake = FakeOpenAI()
+    monkeypatch.setattr(server, "openai_client", fake)
+
+    asyncio.run(server.warm_openai())
+
+    assert fake.models.listed == 1
+    assert fake.options == {"timeout": server.OPENAI_WARMUP_TIMEOUT}
+
+
+def test_openai_client_is_async():
+    assert isinstance(server.openai_client, server.openai.AsyncOpenAI)